@@ -4,40 +4,100 @@ Handles file versioning, git commits, and directory management
 """
 
 import os
+import re
+import json
+import time
+import queue
 import shutil
+import threading
 import subprocess
+from collections import defaultdict
 from pathlib import Path
 from typing import Optional, List, Tuple
 from datetime import datetime
 
 from gcode_parser import GCodeMetadata
 
+try:
+    import pygit2
+    PYGIT2_AVAILABLE = True
+except ImportError:
+    PYGIT2_AVAILABLE = False
+
+
+# ASCII characters that aren't word characters or '-' map to '_'
+_SANITIZE_TABLE = {
+    c: '_' for c in range(128)
+    if not (chr(c).isalnum() or chr(c) in '-_')
+}
+_NON_WORD_RE = re.compile(r'[^\w\-]')
+_UNDERSCORES_RE = re.compile(r'_+')
+
+# Queue marker asking the commit worker to commit what it has right away
+_FLUSH = object()
+
 
 class FileManager:
     """Manages G-code file versioning and git repository"""
 
-    def __init__(self, parts_archive_dir: str, ftp_dir: str):
+    # Most archived versions folded into a single git commit
+    COMMIT_BATCH_SIZE = 32
+
+    # Per-part file holding the latest version number
+    VERSION_FILE = ".version"
+
+    # Per-part changelog: append-only entries, rendered to Markdown on commit
+    ENTRIES_FILE = "entries.jsonl"
+    CHANGELOG_FILE = "CHANGELOG.md"
+    LEGACY_CHANGELOG_FILE = "CHANGELOG.legacy.md"
+
+    def __init__(self, parts_archive_dir: str, ftp_dir: str, commit_delay: float = 5.0):
         """
         Initialize file manager
 
         Args:
             parts_archive_dir: Root directory for parts git repository
             ftp_dir: Directory where CNC machines access files
+            commit_delay: Seconds to collect new versions before committing them together
         """
         self.parts_archive = Path(parts_archive_dir)
         self.ftp_dir = Path(ftp_dir)
+        self.commit_delay = commit_delay
+
+        # Directories already created/verified, so repeat posts skip mkdir
+        self._known_dirs = set()
+
+        # Serializes version numbering and FTP cleanup across ingest threads
+        self._lock = threading.Lock()
 
         # Ensure directories exist
-        self.parts_archive.mkdir(parents=True, exist_ok=True)
-        self.ftp_dir.mkdir(parents=True, exist_ok=True)
+        self._ensure_dir(self.parts_archive)
+        self._ensure_dir(self.ftp_dir)
 
         # Initialize git repo if needed
         self._init_git_repo()
 
+        # Git commits happen on a background thread so archiving doesn't wait on them
+        self._commit_queue = queue.Queue()
+        self._commit_thread = threading.Thread(
+            target=self._commit_worker,
+            name="russ-git-commit",
+            daemon=True
+        )
+        self._commit_thread.start()
+
     def _init_git_repo(self):
         """Initialize git repository in parts archive if not already initialized"""
         git_dir = self.parts_archive / ".git"
         if not git_dir.exists():
+            if PYGIT2_AVAILABLE:
+                try:
+                    pygit2.init_repository(str(self.parts_archive))
+                    print(f"✅ Initialized git repository in {self.parts_archive}")
+                except pygit2.GitError as e:
+                    print(f"❌ Failed to initialize git repo: {e}")
+                return
+
             try:
                 subprocess.run(
                     ["git", "init"],
@@ -54,7 +114,7 @@ class FileManager:
         # Sanitize project name for filesystem
         safe_name = self._sanitize_filename(project_name)
         project_dir = self.parts_archive / safe_name
-        project_dir.mkdir(parents=True, exist_ok=True)
+        self._ensure_dir(project_dir)
         return project_dir
 
     def get_part_dir(self, project_name: str, part_name: str) -> Path:
@@ -62,16 +122,24 @@ class FileManager:
         project_dir = self.get_project_dir(project_name)
         safe_part = self._sanitize_filename(part_name)
         part_dir = project_dir / safe_part
-        part_dir.mkdir(parents=True, exist_ok=True)
+        self._ensure_dir(part_dir)
         return part_dir
 
+    def _ensure_dir(self, path: Path):
+        """Create a directory unless it has already been created this run"""
+        if path not in self._known_dirs:
+            path.mkdir(parents=True, exist_ok=True)
+            self._known_dirs.add(path)
+
     def _sanitize_filename(self, name: str) -> str:
         """Sanitize string for use as filename/directory"""
-        import re
         # Replace spaces and special chars with underscores
-        safe = re.sub(r'[^\w\-]', '_', name)
+        safe = name.translate(_SANITIZE_TABLE)
+        if not safe.isascii():
+            # Unicode punctuation/symbols need the full \w check
+            safe = _NON_WORD_RE.sub('_', safe)
         # Remove multiple underscores
-        safe = re.sub(r'_+', '_', safe)
+        safe = _UNDERSCORES_RE.sub('_', safe)
         # Remove leading/trailing underscores
         safe = safe.strip('_')
         return safe.lower()
@@ -84,21 +152,50 @@ class FileManager:
             List of file paths, sorted by modification time (newest first)
         """
         part_dir = self.get_part_dir(project, part)
-        nc_files = list(part_dir.glob("*.nc"))
-        # Sort by modification time, newest first
-        nc_files.sort(key=lambda x: x.stat().st_mtime, reverse=True)
+        return [path for _, path in self._scan_nc_files(part_dir)]
+
+    def _scan_nc_files(self, directory: Path) -> List[Tuple[float, Path]]:
+        """
+        List .nc files in a directory with their modification times
+
+        Uses os.scandir so the stat comes from the directory entry rather
+        than a separate lookup per file.
+
+        Returns:
+            List of (mtime, path) tuples, sorted newest first
+        """
+        with os.scandir(directory) as entries:
+            nc_files = [
+                (entry.stat().st_mtime, Path(entry.path))
+                for entry in entries
+                if entry.name.endswith(".nc") and entry.is_file()
+            ]
+        nc_files.sort(reverse=True)
         return nc_files
 
     def get_next_version_number(self, project: str, part: str) -> int:
         """Get next version number for a part"""
-        existing = self.get_existing_versions(project, part)
-        return len(existing) + 1
+        part_dir = self.get_part_dir(project, part)
+        try:
+            current = int((part_dir / self.VERSION_FILE).read_text())
+        except (FileNotFoundError, ValueError):
+            # Part archived before the counter existed - count the versions
+            current = len(self.get_existing_versions(project, part))
+        return current + 1
+
+    def _store_version_number(self, part_dir: Path, version: int):
+        """Record the latest version number for a part (atomic replace)"""
+        version_file = part_dir / self.VERSION_FILE
+        tmp_file = part_dir / (self.VERSION_FILE + ".tmp")
+        tmp_file.write_text(f"{version}\n")
+        os.replace(tmp_file, version_file)
 
     def archive_gcode(
         self,
         source_file: str,
         metadata: GCodeMetadata,
-        commit: bool = True
+        commit: bool = True,
+        content: Optional[bytes] = None
     ) -> Tuple[Path, int]:
         """
         Archive G-code file to parts repository
@@ -107,6 +204,7 @@ class FileManager:
             source_file: Path to source .nc file
             metadata: Parsed metadata
             commit: Whether to git commit
+            content: Contents of source_file if already read, to avoid re-reading it
 
         Returns:
             Tuple of (archived_file_path, version_number)
@@ -114,95 +212,215 @@ class FileManager:
         # Get destination directory
         part_dir = self.get_part_dir(metadata.project, metadata.part)
 
-        # Get version number
-        version = self.get_next_version_number(metadata.project, metadata.part)
+        # Number, write and log the version as one step
+        with self._lock:
+            # Get version number
+            version = self.get_next_version_number(metadata.project, metadata.part)
 
-        # Build filename with version
-        safe_part = self._sanitize_filename(metadata.part)
-        filename = f"{safe_part}_v{version}_{metadata.posted_timestamp}.nc"
-        dest_path = part_dir / filename
+            # Build filename with version
+            safe_part = self._sanitize_filename(metadata.part)
+            filename = f"{safe_part}_v{version}_{metadata.posted_timestamp}.nc"
+            dest_path = part_dir / filename
 
-        # Copy file
-        shutil.copy2(source_file, dest_path)
-        print(f"📦 Archived to: {dest_path}")
+            # Copy file
+            if content is not None:
+                dest_path.write_bytes(content)
+            else:
+                shutil.copy2(source_file, dest_path)
+            self._store_version_number(part_dir, version)
+            print(f"📦 Archived to: {dest_path}")
 
-        # Create/update CHANGELOG
-        self._update_changelog(part_dir, metadata, version)
+            # Create/update CHANGELOG (rendered by the commit thread when committing)
+            self._update_changelog(part_dir, metadata, version, render=not commit)
 
-        # Git commit
-        if commit:
-            self._git_commit(metadata, version, dest_path)
+            # Git commit (batched on the commit thread)
+            if commit:
+                self._commit_queue.put((metadata, version, dest_path))
 
         return dest_path, version
 
-    def _update_changelog(self, part_dir: Path, metadata: GCodeMetadata, version: int):
-        """Update CHANGELOG.md for the part"""
-        changelog_path = part_dir / "CHANGELOG.md"
+    def _update_changelog(self, part_dir: Path, metadata: GCodeMetadata, version: int, render: bool):
+        """Record a changelog entry for the part, optionally rendering CHANGELOG.md now"""
+        entries_path = part_dir / self.ENTRIES_FILE
+        changelog_path = part_dir / self.CHANGELOG_FILE
 
-        # Create header if new file
-        if not changelog_path.exists():
-            header = f"# {metadata.part} - Change Log\n\n"
-            header += f"Project: {metadata.project}\n\n"
-        else:
-            header = ""
-
-        # Read existing content
-        existing_content = ""
-        if changelog_path.exists():
-            with open(changelog_path, 'r') as f:
-                lines = f.readlines()
-                # Skip header if it exists
-                if lines and lines[0].startswith('#'):
-                    existing_content = ''.join(lines[3:])  # Skip header lines
-                else:
-                    existing_content = ''.join(lines)
-
-        # New entry
-        entry = f"## Version {version} - {metadata.posted_timestamp}\n\n"
-        entry += f"- **Setup:** {metadata.setup}\n"
-        entry += f"- **Machine:** {metadata.machine}\n"
-        entry += f"- **Operations:** {metadata.operations}\n"
-        entry += f"- **Tools:** {metadata.tool_count}\n"
-        entry += f"- **Posted:** {metadata.posted_datetime or metadata.posted_timestamp}\n\n"
-
-        # Write updated changelog
-        with open(changelog_path, 'w') as f:
-            if header:
-                f.write(header)
-            f.write(entry)
-            f.write(existing_content)
+        # Keep entries from a CHANGELOG.md written before entries.jsonl existed
+        if not entries_path.exists() and changelog_path.exists():
+            existing = changelog_path.read_text()
+            split = existing.find("## Version")
+            if split >= 0:
+                (part_dir / self.LEGACY_CHANGELOG_FILE).write_text(existing[split:])
+
+        entry = {**metadata.to_dict(), 'version': version}
+        with open(entries_path, 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+
+        if render:
+            self.render_changelog(part_dir)
+
+    def render_changelog(self, part_dir: Path) -> Path:
+        """
+        Regenerate CHANGELOG.md for a part from its entries.jsonl
+
+        Returns:
+            Path to CHANGELOG.md
+        """
+        changelog_path = part_dir / self.CHANGELOG_FILE
+        with open(part_dir / self.ENTRIES_FILE) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+
+        first = GCodeMetadata.from_dict(entries[0])
+        content = f"# {first.part} - Change Log\n\n"
+        content += f"Project: {first.project}\n\n"
+
+        # Newest first
+        for entry in reversed(entries):
+            metadata = GCodeMetadata.from_dict(entry)
+            content += f"## Version {entry['version']} - {metadata.posted_timestamp}\n\n"
+            content += f"- **Setup:** {metadata.setup}\n"
+            content += f"- **Machine:** {metadata.machine}\n"
+            content += f"- **Operations:** {metadata.operations}\n"
+            content += f"- **Tools:** {metadata.tool_count}\n"
+            content += f"- **Posted:** {metadata.posted_datetime or metadata.posted_timestamp}\n\n"
+
+        legacy_path = part_dir / self.LEGACY_CHANGELOG_FILE
+        if legacy_path.exists():
+            content += legacy_path.read_text()
+
+        tmp_path = part_dir / (self.CHANGELOG_FILE + ".tmp")
+        tmp_path.write_text(content)
+        os.replace(tmp_path, changelog_path)
 
         print(f"📝 Updated changelog: {changelog_path}")
+        return changelog_path
 
-    def _git_commit(self, metadata: GCodeMetadata, version: int, file_path: Path):
-        """Create git commit for new version"""
-        try:
-            # Get relative path for git
-            rel_path = file_path.relative_to(self.parts_archive)
-            changelog_path = file_path.parent / "CHANGELOG.md"
-            rel_changelog = changelog_path.relative_to(self.parts_archive)
+    def flush(self):
+        """Block until every queued version has been committed"""
+        self._commit_queue.put(_FLUSH)
+        self._commit_queue.join()
 
-            # Add files
-            subprocess.run(
-                ["git", "add", str(rel_path), str(rel_changelog)],
-                cwd=self.parts_archive,
-                check=True,
-                capture_output=True
-            )
+    def close(self):
+        """Commit anything still queued and stop the commit thread"""
+        self._commit_queue.put(None)
+        self._commit_thread.join()
 
-            # Commit message
+    def _commit_worker(self):
+        """
+        Commit queued versions in batches
+
+        Waits up to commit_delay after the first queued version (or until
+        COMMIT_BATCH_SIZE versions are waiting) and commits them together.
+        """
+        running = True
+        while running:
+            item = self._commit_queue.get()
+            batch = []
+            received = 1
+            deadline = time.monotonic() + self.commit_delay
+
+            while True:
+                if item is None:
+                    running = False
+                    break
+                if item is _FLUSH:
+                    break
+                batch.append(item)
+                if len(batch) >= self.COMMIT_BATCH_SIZE:
+                    break
+                try:
+                    item = self._commit_queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                received += 1
+
+            try:
+                if batch:
+                    self._git_commit(batch)
+            except Exception as e:
+                print(f"⚠️ Git commit failed: {e}")
+            finally:
+                for _ in range(received):
+                    self._commit_queue.task_done()
+
+    def _git_commit(self, batch: List[Tuple[GCodeMetadata, int, Path]]):
+        """Create one git commit for a batch of (metadata, version, file_path) entries"""
+        part_dirs = list(dict.fromkeys(file_path.parent for _, _, file_path in batch))
+
+        # Render each part's changelog once for the whole batch
+        with self._lock:
+            for part_dir in part_dirs:
+                self.render_changelog(part_dir)
+
+        # Stage every file in the touched part dirs, so versions left
+        # uncommitted by an earlier crash are picked up by this commit
+        rel_paths = []
+        for part_dir in part_dirs:
+            with os.scandir(part_dir) as entries:
+                rel_paths.extend(
+                    Path(e.path).relative_to(self.parts_archive) for e in entries
+                    if e.is_file(follow_symlinks=False) and not e.name.endswith(".tmp")
+                )
+
+        # Commit message
+        if len(batch) == 1:
+            metadata, version, _ = batch[0]
             commit_msg = f"{metadata.part} v{version} - {metadata.setup}\n\n"
             commit_msg += f"Project: {metadata.project}\n"
             commit_msg += f"Machine: {metadata.machine}\n"
             commit_msg += f"Operations: {metadata.operations}\n"
             commit_msg += f"Tools: {metadata.tool_count}\n"
             commit_msg += f"Posted: {metadata.posted_timestamp}\n\n"
-            commit_msg += "🤖 Committed by Russ (Chip Warden)"
+        else:
+            commit_msg = f"Archived {len(batch)} programs\n\n"
+            for metadata, version, _ in batch:
+                commit_msg += f"- {metadata.part} v{version} - {metadata.setup} ({metadata.project}, {metadata.machine})\n"
+            commit_msg += "\n"
+        commit_msg += "🤖 Committed by Russ (Chip Warden)"
+
+        if PYGIT2_AVAILABLE:
+            self._git_commit_pygit2(rel_paths, commit_msg)
+        else:
+            self._git_commit_subprocess(rel_paths, commit_msg)
+
+    def _git_commit_pygit2(self, rel_paths: List[Path], commit_msg: str):
+        """Stage files and commit in-process via libgit2"""
+        try:
+            repo = pygit2.Repository(str(self.parts_archive))
+
+            # Add files
+            for rel_path in rel_paths:
+                repo.index.add(rel_path.as_posix())
+            repo.index.write()
+            tree = repo.index.write_tree()
+
+            # Unborn HEAD means this is the first commit
+            parents = [] if repo.head_is_unborn else [repo.head.target]
+
+            try:
+                signature = repo.default_signature
+            except (KeyError, pygit2.GitError):
+                # No user.name/user.email configured for this repo
+                signature = pygit2.Signature("Russ (Chip Warden)", "russ@chip-warden.local")
 
             # Commit
+            repo.create_commit("HEAD", signature, signature, commit_msg, tree, parents)
+
+            print(f"✅ Git commit created")
+
+        except (pygit2.GitError, OSError) as e:
+            print(f"⚠️ Git commit failed: {e}")
+
+    def _git_commit_subprocess(self, rel_paths: List[Path], commit_msg: str):
+        """Stage files and commit using the git command line"""
+        try:
+            # Add and commit in one shell; paths are passed as positional
+            # args and the message on stdin so nothing needs quoting
             subprocess.run(
-                ["git", "commit", "-m", commit_msg],
+                ["sh", "-c", 'git add -- "$@" && git commit -q -F -', "sh"]
+                + [str(p) for p in rel_paths],
                 cwd=self.parts_archive,
+                input=commit_msg,
+                text=True,
                 check=True,
                 capture_output=True
             )
@@ -216,7 +434,8 @@ class FileManager:
         self,
         source_file: Path,
         metadata: GCodeMetadata,
-        version: int
+        version: int,
+        content: Optional[bytes] = None
     ) -> Path:
         """
         Copy file to FTP directory with clear naming
@@ -225,6 +444,7 @@ class FileManager:
             source_file: Path to archived file
             metadata: Metadata
             version: Version number
+            content: Contents of source_file if already in memory, to avoid re-reading it
 
         Returns:
             Path to FTP file
@@ -233,11 +453,36 @@ class FileManager:
         filename = f"{safe_part}_v{version}_{metadata.posted_timestamp}.nc"
         ftp_path = self.ftp_dir / filename
 
-        shutil.copy2(source_file, ftp_path)
+        if content is not None:
+            ftp_path.write_bytes(content)
+        else:
+            self._copy_file(source_file, ftp_path)
         print(f"📤 Copied to FTP: {ftp_path}")
 
         return ftp_path
 
+    def _copy_file(self, source: Path, dest: Path):
+        """
+        Copy file contents only (no copystat), using sendfile where available
+
+        The FTP copy doesn't need the archive's permissions or timestamps,
+        and sendfile keeps the data in the kernel.
+        """
+        with open(source, 'rb') as src, open(dest, 'wb') as dst:
+            size = os.fstat(src.fileno()).st_size
+            offset = 0
+            try:
+                while offset < size:
+                    sent = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+            except (AttributeError, OSError):
+                # No sendfile on this platform/filesystem - finish in userspace
+                src.seek(offset)
+                dst.seek(offset)
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+
     def cleanup_old_ftp_files(self, keep_count: int = 2):
         """
         Clean up old files from FTP directory
@@ -245,29 +490,31 @@ class FileManager:
         Args:
             keep_count: How many recent files to keep per part
         """
-        # Group files by part name (extract from filename)
-        from collections import defaultdict
-        files_by_part = defaultdict(list)
-
-        for nc_file in self.ftp_dir.glob("*.nc"):
-            # Extract part name from filename (before first underscore or version marker)
-            part_key = nc_file.stem.split('_v')[0]
-            files_by_part[part_key].append(nc_file)
-
-        # Clean up old files for each part
-        removed_count = 0
-        for part, files in files_by_part.items():
-            # Sort by modification time, newest first
-            files.sort(key=lambda x: x.stat().st_mtime, reverse=True)
-
-            # Remove old files
-            for old_file in files[keep_count:]:
-                old_file.unlink()
-                print(f"🗑️  Removed old FTP file: {old_file.name}")
-                removed_count += 1
-
-        if removed_count > 0:
-            print(f"✅ Cleaned up {removed_count} old files from FTP directory")
+        with self._lock:
+            # Group files by part name (extract from filename) in one directory pass
+            files_by_part = defaultdict(list)
+            with os.scandir(self.ftp_dir) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(".nc") or not entry.is_file():
+                        continue
+                    # Part name is everything before the version marker
+                    part_key = entry.name[:-len(".nc")].split('_v', 1)[0]
+                    files_by_part[part_key].append((entry.stat().st_mtime, entry.name, entry.path))
+
+            # Clean up old files for each part
+            removed_count = 0
+            for files in files_by_part.values():
+                # Sort by modification time, newest first
+                files.sort(reverse=True)
+
+                # Remove old files
+                for _, name, path in files[keep_count:]:
+                    os.unlink(path)
+                    print(f"🗑️  Removed old FTP file: {name}")
+                    removed_count += 1
+
+            if removed_count > 0:
+                print(f"✅ Cleaned up {removed_count} old files from FTP directory")
 
         return removed_count
 
@@ -309,4 +556,7 @@ if __name__ == "__main__":
         ftp_path = fm.copy_to_ftp(archived_path, metadata, version)
         print(f"✅ Test FTP copy: {ftp_path}")
 
+        # Wait for the background git commit
+        fm.close()
+
         print("\n✅ File manager test complete")
@@ -49,6 +49,20 @@ class GCodeMetadata:
             'program_number': self.program_number
         }
 
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'GCodeMetadata':
+        """Rebuild metadata from a to_dict() dictionary"""
+        return cls(
+            project=data['project'],
+            part=data['part'],
+            posted_timestamp=data['posted'],
+            operations=data['operations'],
+            tool_count=data['tool_count'],
+            machine=data['machine'],
+            setup=data['setup'],
+            program_number=data.get('program_number')
+        )
+
 
 class GCodeParser:
     """Parse G-code files and extract Chip Warden metadata"""
@@ -56,8 +70,15 @@ class GCodeParser:
     METADATA_START = "CHIP-WARDEN-START"
     METADATA_END = "CHIP-WARDEN-END"
 
-    def __init__(self):
-        self.metadata_pattern = re.compile(r'\(([^)]+)\)')
+    # The metadata block is written at the top of the program, so only
+    # this much of a file is read and scanned
+    HEADER_LIMIT = 64 * 1024
+
+    # Program number line (O1001) ahead of the metadata block
+    PROGRAM_RE = re.compile(r"^[ \t]*O(\d+)", re.M)
+
+    # "(KEY: value)" or "(KEY value)" comments inside the block
+    KV_RE = re.compile(r"\(\s*([\w-]+)\s*(?::\s*|\s+)([^)]*?)\s*\)")
 
     def parse_file(self, filepath: str) -> Optional[GCodeMetadata]:
         """
@@ -70,8 +91,10 @@ class GCodeParser:
             GCodeMetadata object or None if metadata not found
         """
         try:
-            with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
-                return self.parse_content(f.read())
+            # Only the header is needed; programs can be many MB
+            with open(filepath, 'rb') as f:
+                header = f.read(self.HEADER_LIMIT)
+            return self.parse_content(header.decode('utf-8', errors='ignore'))
         except Exception as e:
             print(f"Error reading file {filepath}: {e}")
             return None
@@ -86,52 +109,23 @@ class GCodeParser:
         Returns:
             GCodeMetadata object or None if metadata not found
         """
-        lines = content.split('\n')
-
-        # Find metadata block
-        in_metadata = False
-        metadata = {}
-        program_number = None
-
-        for line in lines:
-            line = line.strip()
-
-            # Extract program number (O1001 format)
-            if line.startswith('O') and program_number is None:
-                match = re.match(r'O(\d+)', line)
-                if match:
-                    program_number = match.group(1)
-
-            # Check for metadata markers
-            if self.METADATA_START in line:
-                in_metadata = True
-                continue
-            elif self.METADATA_END in line:
-                break
-
-            # Parse metadata lines
-            if in_metadata:
-                # Extract comment content
-                match = self.metadata_pattern.search(line)
-                if match:
-                    comment = match.group(1)
-
-                    # Parse key: value or key value format
-                    if ':' in comment:
-                        key, value = comment.split(':', 1)
-                    elif ' ' in comment:
-                        # Handle "PROJECT value" format (no colon)
-                        parts = comment.split(None, 1)  # Split on first whitespace
-                        if len(parts) == 2:
-                            key, value = parts
-                        else:
-                            continue
-                    else:
-                        continue
-
-                    key = key.strip().lower().replace('-', '_')
-                    value = value.strip()
-                    metadata[key] = value
+        # Plain substring search first: files without a block bail out here
+        header = content[:self.HEADER_LIMIT]
+        start = header.find(self.METADATA_START)
+        if start < 0:
+            return None
+        end = header.find(self.METADATA_END, start)
+        if end < 0:
+            return None
+        block = header[start + len(self.METADATA_START):end]
+
+        program = self.PROGRAM_RE.search(header, 0, start)
+        program_number = program.group(1) if program else None
+
+        metadata = {
+            key.lower().replace('-', '_'): value
+            for key, value in self.KV_RE.findall(block)
+        }
 
         # Validate we have minimum required fields
         required_fields = ['project', 'part', 'posted']
@@ -8,23 +8,101 @@ Named after Russ, the lead machinist who never scrapped a part.
 
 import os
 import sys
-import time
+import json
 import yaml
-import asyncio
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    # PyYAML built without libyaml
+    from yaml import SafeLoader
+import queue
+import signal
 import logging
+import logging.handlers
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Tuple
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler, FileCreatedEvent
+from watchdog.events import FileSystemEventHandler
 
 from gcode_parser import GCodeParser, GCodeMetadata
 from file_manager import FileManager
 from telegram_bot import TelegramNotifier, load_telegram_token, TELEGRAM_AVAILABLE
 
 
+class ProcessedFiles:
+    """
+    Bounded record of files already handled, persisted across restarts
+
+    Files are keyed on (device, inode, mtime) so a moved or renamed file is
+    still recognised, while a rewritten one (new mtime) is processed again.
+    Only the most recent max_entries keys are kept.
+    """
+
+    def __init__(self, state_file: Path, max_entries: int = 1024):
+        self.state_file = state_file
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def key_for(file_path: Path) -> Optional[Tuple[int, int, int]]:
+        """Identity key for a file, or None if it no longer exists"""
+        try:
+            st = file_path.stat()
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino, st.st_mtime_ns)
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return True
+            return False
+
+    def add(self, key):
+        """Record a key, evicting the oldest beyond max_entries, and save"""
+        with self._lock:
+            self._entries[key] = None
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            keys = list(self._entries)
+            self._save(keys)
+
+    def discard(self, key):
+        """Forget a key (e.g. after a failed attempt) so it is retried"""
+        with self._lock:
+            if key not in self._entries:
+                return
+            del self._entries[key]
+            keys = list(self._entries)
+            self._save(keys)
+
+    def _load(self):
+        try:
+            keys = json.loads(self.state_file.read_text())
+        except (FileNotFoundError, ValueError):
+            return
+        for key in keys[-self.max_entries:]:
+            self._entries[tuple(key)] = None
+
+    def _save(self, keys):
+        tmp_file = self.state_file.with_name(self.state_file.name + ".tmp")
+        tmp_file.write_text(json.dumps(keys))
+        os.replace(tmp_file, self.state_file)
+
+
 class GCodeFileHandler(FileSystemEventHandler):
     """Handles new G-code files posted by Fusion 360"""
 
+    # Parsed archived versions kept for comparing against the next post
+    METADATA_CACHE_SIZE = 512
+
     def __init__(
         self,
         parser: GCodeParser,
@@ -38,38 +116,94 @@ class GCodeFileHandler(FileSystemEventHandler):
         self.config = config
         self.logger = logging.getLogger('russ')
 
-        # Track processed files to avoid duplicates
-        self.processed_files = set()
+        # Track processed files to avoid duplicates (survives restarts)
+        log_dir = Path(config['directories'].get('logs', 'russ/logs'))
+        self.processed_files = ProcessedFiles(log_dir / 'processed_files.json')
+
+        # Archived versions never change once written, so their parsed
+        # metadata can be reused; (mtime, size) in the key catches rewrites.
+        # Each new version is added as it is archived, so the next post of
+        # the same part finds its previous version here without a re-read.
+        self._metadata_cache = OrderedDict()
+        self._metadata_lock = threading.Lock()
+
+    @staticmethod
+    def _metadata_key(path: Path) -> Tuple[str, int, int]:
+        st = path.stat()
+        return (str(path), st.st_mtime_ns, st.st_size)
+
+    def _archived_metadata(self, path: Path) -> Optional[GCodeMetadata]:
+        """Metadata of an archived version, parsing the file only on a cache miss"""
+        key = self._metadata_key(path)
+        with self._metadata_lock:
+            if key in self._metadata_cache:
+                self._metadata_cache.move_to_end(key)
+                return self._metadata_cache[key]
+
+        metadata = self.parser.parse_file(str(path))
+        self._remember_metadata(key, metadata)
+        return metadata
+
+    def _remember_metadata(self, key: Tuple[str, int, int], metadata: Optional[GCodeMetadata]):
+        """Cache parsed metadata, evicting the oldest beyond METADATA_CACHE_SIZE"""
+        with self._metadata_lock:
+            self._metadata_cache[key] = metadata
+            self._metadata_cache.move_to_end(key)
+            while len(self._metadata_cache) > self.METADATA_CACHE_SIZE:
+                self._metadata_cache.popitem(last=False)
+
+    def on_closed(self, event):
+        """
+        Handle file close-after-write events
 
-    def on_created(self, event):
-        """Handle file creation events"""
+        inotify reports IN_CLOSE_WRITE once the writer (Fusion 360 / Samba)
+        closes the file, so the contents are complete by the time we read it.
+        """
         if event.is_directory:
             return
+        self._handle_arrival(Path(event.src_path))
+
+    def on_moved(self, event):
+        """
+        Handle files moved or renamed into the watched directory
 
+        A move produces no IN_CLOSE_WRITE, and the file is already complete.
+        """
+        # Moves out of the directory have no destination
+        if event.is_directory or not event.dest_path:
+            return
+        self._handle_arrival(Path(event.dest_path))
+
+    def _handle_arrival(self, file_path: Path):
+        """Process a file that has arrived, unless it isn't G-code or was already handled"""
         # Only process .nc and .gcode files
-        file_path = Path(event.src_path)
         if file_path.suffix.lower() not in ['.nc', '.gcode']:
             return
 
         # Avoid processing the same file multiple times
-        if file_path in self.processed_files:
+        key = ProcessedFiles.key_for(file_path)
+        if key is None or key in self.processed_files:
             return
 
-        # Wait a moment for file to finish writing
-        time.sleep(0.5)
-
         self.logger.info(f"📥 New file detected: {file_path.name}")
         self.process_file(file_path)
 
     def process_file(self, file_path: Path):
         """Process a new G-code file"""
+        key = ProcessedFiles.key_for(file_path)
+        version = None
         try:
-            # Mark as processed
-            self.processed_files.add(file_path)
+            # Mark as processed (dropped again below if it fails before archiving)
+            if key is not None:
+                self.processed_files.add(key)
+
+            # Read once; the same bytes are parsed and archived
+            data = file_path.read_bytes()
 
-            # Parse metadata
+            # Parse metadata (only the header can hold it)
             self.logger.info(f"🔍 Parsing metadata from {file_path.name}")
-            metadata = self.parser.parse_file(str(file_path))
+            header = data[:self.parser.HEADER_LIMIT].decode('utf-8', errors='ignore')
+            metadata = self.parser.parse_content(header)
 
             if not metadata:
                 self.logger.warning(f"⚠️ No Chip Warden metadata found in {file_path.name}")
@@ -90,7 +224,7 @@ class GCodeFileHandler(FileSystemEventHandler):
 
             if existing_versions:
                 # Parse previous version for comparison
-                prev_metadata = self.parser.parse_file(str(existing_versions[0]))
+                prev_metadata = self._archived_metadata(existing_versions[0])
                 if prev_metadata:
                     changes = self.parser.compare_metadata(prev_metadata, metadata)
                     if changes['warnings']:
@@ -103,15 +237,19 @@ class GCodeFileHandler(FileSystemEventHandler):
             archived_path, version = self.file_manager.archive_gcode(
                 str(file_path),
                 metadata,
-                commit=self.config.get('git', {}).get('auto_commit', True)
+                commit=self.config.get('git', {}).get('auto_commit', True),
+                content=data
             )
+            # Same bytes as the archived file, so this is what parsing it would give
+            self._remember_metadata(self._metadata_key(archived_path), metadata)
 
             # Copy to FTP directory
             self.logger.info(f"📤 Copying to FTP directory...")
             ftp_path = self.file_manager.copy_to_ftp(
                 archived_path,
                 metadata,
-                version
+                version,
+                content=data
             )
 
             # Clean up old FTP files
@@ -121,7 +259,7 @@ class GCodeFileHandler(FileSystemEventHandler):
             # Send Telegram notification
             if self.telegram and self.config.get('telegram', {}).get('notify_on_post', True):
                 self.logger.info(f"📱 Sending Telegram notification...")
-                asyncio.run(self.telegram.notify_new_file(
+                self.telegram.run_coroutine(self.telegram.notify_new_file(
                     project=metadata.project,
                     part=metadata.part,
                     version=version,
@@ -139,13 +277,29 @@ class GCodeFileHandler(FileSystemEventHandler):
 
         except Exception as e:
             self.logger.error(f"❌ Error processing {file_path.name}: {e}", exc_info=True)
+            if version is not None:
+                # Retrying would archive the same post again as a new version
+                self.logger.warning(f"   Already archived as v{version}; {file_path.name} left in place")
+            elif key is not None:
+                # Let a restart with --process-existing retry it
+                try:
+                    self.processed_files.discard(key)
+                except OSError as save_error:
+                    self.logger.warning(f"⚠️ Could not update processed files: {save_error}")
             if self.telegram:
-                asyncio.run(self.telegram.notify_error(f"Error processing {file_path.name}: {e}"))
+                # Never let a slow or failed report escape into watchdog's thread
+                try:
+                    self.telegram.run_coroutine(self.telegram.notify_error(f"Error processing {file_path.name}: {e}"))
+                except Exception as notify_error:
+                    self.logger.warning(f"⚠️ Could not send error notification: {notify_error}")
 
 
 class Russ:
     """Main Chip Warden agent"""
 
+    # Threads used to ingest files already waiting at startup
+    INGEST_WORKERS = 4
+
     def __init__(self, config_path: str = "russ/config/config.yml"):
         """
         Initialize Russ
@@ -162,7 +316,8 @@ class Russ:
         self.parser = GCodeParser()
         self.file_manager = FileManager(
             self.config['directories']['parts_archive'],
-            self.config['directories']['ftp_share']
+            self.config['directories']['ftp_share'],
+            commit_delay=self.config.get('git', {}).get('commit_delay_seconds', 5)
         )
 
         # Initialize Telegram if configured
@@ -180,9 +335,16 @@ class Russ:
             else:
                 self.logger.warning("⚠️ Telegram enabled but token/chat_id not configured")
 
+        # File handler (also used by process_existing_files before watching starts)
+        self.handler = GCodeFileHandler(
+            self.parser,
+            self.file_manager,
+            self.telegram,
+            self.config
+        )
+
         # File watcher
         self.observer = None
-        self.handler = None
 
     def load_config(self) -> dict:
         """Load configuration from YAML file"""
@@ -193,8 +355,8 @@ class Russ:
             print(f"   Copy config.example.yml to config.yml and customize")
             sys.exit(1)
 
-        with open(config_path, 'r') as f:
-            return yaml.safe_load(f)
+        with open(config_path, 'rb') as f:
+            return yaml.load(f, Loader=SafeLoader)
 
     def setup_logging(self):
         """Setup logging configuration"""
@@ -203,15 +365,22 @@ class Russ:
         log_dir = Path(self.config['directories'].get('logs', 'russ/logs'))
         log_dir.mkdir(parents=True, exist_ok=True)
 
-        # Configure logging
+        # Loggers only enqueue records; a listener thread does the file and
+        # stdout writes so logging never blocks the watcher or the Telegram loop
+        log_queue = queue.Queue(-1)
+        self.log_listener = logging.handlers.QueueListener(
+            log_queue,
+            logging.FileHandler(log_dir / 'russ.log'),
+            logging.StreamHandler(sys.stdout)
+        )
+
+        # Configure logging (records are formatted by the QueueHandler)
         logging.basicConfig(
             level=getattr(logging, log_level),
             format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler(log_dir / 'russ.log'),
-                logging.StreamHandler(sys.stdout)
-            ]
+            handlers=[logging.handlers.QueueHandler(log_queue)]
         )
+        self.log_listener.start()
 
     def start(self):
         """Start watching for files"""
@@ -224,15 +393,9 @@ class Russ:
         watch_dir = Path(self.config['directories']['fusion_output'])
         watch_dir.mkdir(parents=True, exist_ok=True)
 
-        # Setup file watcher
-        self.handler = GCodeFileHandler(
-            self.parser,
-            self.file_manager,
-            self.telegram,
-            self.config
-        )
-
-        self.observer = Observer()
+        # Setup file watcher; full events make a file moved in from outside
+        # the watched directory a move (not a create), so on_moved sees it
+        self.observer = Observer(generate_full_events=True)
         self.observer.schedule(
             self.handler,
             str(watch_dir),
@@ -246,7 +409,7 @@ class Russ:
         # Send startup notification
         if self.telegram and self.config.get('telegram', {}).get('enabled'):
             try:
-                asyncio.run(self.telegram.send_message(
+                self.telegram.run_coroutine(self.telegram.send_message(
                     "🤖 *Russ is online*\n\n"
                     "Chip Warden started - watching for new programs.\n\n"
                     "_In Russ we trust._"
@@ -254,25 +417,48 @@ class Russ:
             except Exception as e:
                 self.logger.warning(f"⚠️ Could not send startup notification: {e}")
 
+        # systemd stops the service with SIGTERM; shut down the same way as
+        # Ctrl+C so queued commits are flushed
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
         try:
-            while True:
-                time.sleep(1)
+            while not stop.wait(1):
+                pass
         except KeyboardInterrupt:
-            self.logger.info("⏹️  Stopping Russ...")
-            self.observer.stop()
+            pass
 
+        self.logger.info("⏹️  Stopping Russ...")
+        self.observer.stop()
         self.observer.join()
+
+        # Commit anything still waiting on the batch window
+        self.file_manager.close()
+
+        if self.telegram:
+            try:
+                self.telegram.run_coroutine(self.telegram.aclose())
+            except Exception as e:
+                self.logger.warning(f"⚠️ Could not close Telegram connection: {e}")
         self.logger.info("👋 Russ stopped")
+        self.log_listener.stop()
 
     def process_existing_files(self):
         """Process any existing files in the fusion output directory"""
         watch_dir = Path(self.config['directories']['fusion_output'])
         nc_files = list(watch_dir.glob("*.nc")) + list(watch_dir.glob("*.gcode"))
 
+        # Skip files handled by a previous run (e.g. ones without metadata)
+        nc_files = [
+            f for f in nc_files
+            if ProcessedFiles.key_for(f) not in self.handler.processed_files
+        ]
+
         if nc_files:
             self.logger.info(f"📂 Found {len(nc_files)} existing files to process")
-            for nc_file in nc_files:
-                self.handler.process_file(nc_file)
+            # Copies are I/O bound; FileManager serializes versioning and git
+            with ThreadPoolExecutor(max_workers=self.INGEST_WORKERS) as pool:
+                list(pool.map(self.handler.process_file, nc_files))
 
 
 def main():
@@ -4,22 +4,157 @@ Sends notifications and handles commands
 """
 
 import os
-from typing import Optional
+import time
+import asyncio
+import logging
+import functools
+import threading
+from collections import deque
+from typing import Optional, Tuple
 from pathlib import Path
 
+logger = logging.getLogger('russ.telegram')
+
 try:
     import telegram
     from telegram import Bot, Update
-    from telegram.ext import Application, CommandHandler, ContextTypes
+    from telegram.error import RetryAfter
+    from telegram.ext import AIORateLimiter, Application, CommandHandler, ContextTypes, filters
+    from telegram.request import HTTPXRequest
     TELEGRAM_AVAILABLE = True
 except ImportError:
     TELEGRAM_AVAILABLE = False
-    print("⚠️ python-telegram-bot not installed. Telegram features disabled.")
+    logger.warning("⚠️ python-telegram-bot not installed. Telegram features disabled.")
+
+
+# Message templates
+_NEW_FILE_TPL = (
+    "🔧 *New Program Posted*\n\n"
+    "📦 *Part:* {part} (v{version})\n"
+    "📁 *Project:* {project}\n"
+    "⚙️ *Setup:* {setup}\n"
+    "🏭 *Machine:* {machine}\n"
+    "🔨 *Tools:* {tools}\n\n"
+    "{warnings_block}"
+    "_File ready on FTP - grab it and run!_"
+)
+_WARNINGS_HEADER = "⚠️ *Warnings:*\n"
+_WARNING_LINE_TPL = "  • {}\n"
+_BATCH_HEADER_TPL = "🔧 *{count} New Programs Posted*\n\n"
+_BATCH_ENTRY_TPL = (
+    "📦 *{part}* (v{version}) - {setup}\n"
+    "   {project} • {machine} • {tools} tools\n"
+)
+_BATCH_FOOTER = "\n_Files ready on FTP - grab them and run!_"
+_CLEANUP_TPL = "🗑️ Cleaned up: `{filename}`\n_FTP directory cleaned_"
+_ERROR_TPL = "❌ *Error in Chip Warden*\n\n```\n{error_msg}\n```"
+_START_MESSAGE = (
+    "🤖 *Russ here - Chip Warden is online*\n\n"
+    "Available commands:\n"
+    "/status - Show system status\n"
+    "/cleanup - Clean up old FTP files\n"
+    "/help - Show this message\n\n"
+    "_In Russ we trust._"
+)
+
+
+class _LoopThread(threading.Thread):
+    """Background thread running the event loop all Telegram calls go through"""
+
+    def __init__(self):
+        super().__init__(name="russ-telegram", daemon=True)
+        self.loop = asyncio.new_event_loop()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+
+_loop_thread = None
+_loop_thread_lock = threading.Lock()
+
+
+def _get_loop_thread() -> _LoopThread:
+    """Start the shared Telegram event loop thread on first use"""
+    global _loop_thread
+    with _loop_thread_lock:
+        if _loop_thread is None:
+            _loop_thread = _LoopThread()
+            _loop_thread.start()
+    return _loop_thread
+
+
+def _build_request(pool_size: int = 8) -> 'HTTPXRequest':
+    """HTTP client with a keep-alive connection pool for Bot API calls"""
+    return HTTPXRequest(
+        connection_pool_size=pool_size,
+        connect_timeout=5,
+        read_timeout=10,
+        pool_timeout=1
+    )
+
+
+class _RateLimiter:
+    """
+    Paces sends to stay under Telegram's limits (about 30 messages/sec
+    overall and 1 message/sec per chat) instead of running into 429s
+    """
+
+    def __init__(self, overall_per_second: int = 30, chat_interval: float = 1.0):
+        self.overall_per_second = overall_per_second
+        self.chat_interval = chat_interval
+        self._lock = None
+        self._recent = deque()   # send times within the last second
+        self._chat_last = {}     # chat_id -> last send time
+
+    async def acquire(self, chat_id: str):
+        """Wait until a message to chat_id may be sent, then record it"""
+        # Created here so it belongs to the loop that sends
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._recent and now - self._recent[0] >= 1.0:
+                    self._recent.popleft()
+
+                wait = 0.0
+                if len(self._recent) >= self.overall_per_second:
+                    wait = 1.0 - (now - self._recent[0])
+                last = self._chat_last.get(chat_id)
+                if last is not None:
+                    wait = max(wait, self.chat_interval - (now - last))
+
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+            self._recent.append(now)
+            self._chat_last[chat_id] = now
+
+    def back_off(self, chat_id: str, delay: float):
+        """Hold further sends to chat_id for delay seconds (Telegram's flood wait)"""
+        # acquire() waits until chat_interval after the last send
+        resume = time.monotonic() + delay - self.chat_interval
+        self._chat_last[chat_id] = max(self._chat_last.get(chat_id, resume), resume)
 
 
 class TelegramNotifier:
     """Handles Telegram notifications for Chip Warden"""
 
+    __slots__ = ("bot_token", "chat_id", "bot", "_request", "_limiter", "loop",
+                 "_pending", "_batcher_task")
+
+    # Attempts per message when Telegram answers with RetryAfter
+    MAX_SEND_ATTEMPTS = 3
+
+    # Seconds a synchronous caller waits for a call on the event loop thread
+    CALL_TIMEOUT = 30
+
+    # Seconds to collect new-file notifications into one message
+    BATCH_DELAY = 0.8
+
     def __init__(self, bot_token: str, chat_id: str):
         """
         Initialize Telegram bot
@@ -33,7 +168,28 @@ class TelegramNotifier:
 
         self.bot_token = bot_token
         self.chat_id = chat_id
-        self.bot = Bot(token=bot_token)
+        # Pooled client so notifications reuse one TLS connection
+        self._request = _build_request()
+        self.bot = Bot(token=bot_token, request=self._request)
+        self._limiter = _RateLimiter()
+
+        # The bot's HTTP client is tied to one loop, so every call runs here
+        self.loop = _get_loop_thread().loop
+
+        # New-file notifications waiting to be batched (created on the loop)
+        self._pending = None
+        self._batcher_task = None
+
+    def run_coroutine(self, coro, timeout: Optional[float] = None):
+        """
+        Run a coroutine on the Telegram event loop thread and wait for its result
+
+        Args:
+            coro: Coroutine, typically one of this notifier's async methods
+            timeout: Seconds to wait (defaults to CALL_TIMEOUT)
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        return future.result(timeout=timeout or self.CALL_TIMEOUT)
 
     async def send_message(self, message: str, parse_mode: str = 'Markdown'):
         """
@@ -43,16 +199,38 @@ class TelegramNotifier:
             message: Message text (supports Markdown)
             parse_mode: 'Markdown' or 'HTML'
         """
-        try:
-            await self.bot.send_message(
-                chat_id=self.chat_id,
-                text=message,
-                parse_mode=parse_mode
-            )
-            return True
-        except Exception as e:
-            print(f"❌ Failed to send Telegram message: {e}")
-            return False
+        for attempt in range(self.MAX_SEND_ATTEMPTS):
+            await self._limiter.acquire(self.chat_id)
+            try:
+                await self.bot.send_message(
+                    chat_id=self.chat_id,
+                    text=message,
+                    parse_mode=parse_mode
+                )
+                return True
+            except RetryAfter as e:
+                # Newer python-telegram-bot versions report a timedelta
+                delay = e.retry_after
+                if hasattr(delay, 'total_seconds'):
+                    delay = delay.total_seconds()
+                # The next acquire() waits this out, as do other queued sends
+                self._limiter.back_off(self.chat_id, delay)
+                if attempt + 1 < self.MAX_SEND_ATTEMPTS:
+                    logger.warning(f"⏳ Telegram rate limit hit, retrying in {delay}s")
+            except Exception as e:
+                logger.error(f"❌ Failed to send Telegram message: {e}")
+                return False
+
+        logger.error(f"❌ Failed to send Telegram message: still rate limited after {self.MAX_SEND_ATTEMPTS} attempts")
+        return False
+
+    async def aclose(self):
+        """Send any batched notifications, then close the bot's HTTP connection pool"""
+        if self._batcher_task:
+            await self._pending.join()
+            self._batcher_task.cancel()
+        # The bot is never initialize()d, so bot.shutdown() would be a no-op
+        await self._request.shutdown()
 
     async def notify_new_file(
         self,
@@ -64,52 +242,143 @@ class TelegramNotifier:
         tools: int,
         warnings: list = None
     ):
-        """Notify about new G-code file posted"""
-        message = f"🔧 *New Program Posted*\n\n"
-        message += f"📦 *Part:* {part} (v{version})\n"
-        message += f"📁 *Project:* {project}\n"
-        message += f"⚙️ *Setup:* {setup}\n"
-        message += f"🏭 *Machine:* {machine}\n"
-        message += f"🔨 *Tools:* {tools}\n\n"
+        """
+        Notify about new G-code file posted
 
+        Queued and sent after BATCH_DELAY, combined with any other files
+        posted in the meantime, to stay under the per-chat rate limit.
+        """
+        if self._batcher_task is None:
+            self._pending = asyncio.Queue()
+            self._batcher_task = asyncio.create_task(self._send_batches())
+
+        self._pending.put_nowait({
+            'project': project,
+            'part': part,
+            'version': version,
+            'setup': setup,
+            'machine': machine,
+            'tools': tools,
+            'warnings': warnings
+        })
+
+    async def _send_batches(self):
+        """Background task: send queued new-file notifications in batches"""
+        while True:
+            batch = [await self._pending.get()]
+            await asyncio.sleep(self.BATCH_DELAY)
+            while not self._pending.empty():
+                batch.append(self._pending.get_nowait())
+
+            try:
+                if len(batch) == 1:
+                    await self.send_message(self._format_new_file(**batch[0]))
+                else:
+                    await self.send_message(self._format_new_files(batch))
+            finally:
+                for _ in batch:
+                    self._pending.task_done()
+
+    def _format_new_files(self, batch: list) -> str:
+        """Combined message for several files posted together"""
+        parts = [_BATCH_HEADER_TPL.format(count=len(batch))]
+        for entry in batch:
+            parts.append(_BATCH_ENTRY_TPL.format_map(entry))
+            parts.extend(_WARNING_LINE_TPL.format(warning) for warning in entry['warnings'] or [])
+        parts.append(_BATCH_FOOTER)
+        return "".join(parts)
+
+    def _format_new_file(
+        self,
+        project: str,
+        part: str,
+        version: int,
+        setup: str,
+        machine: str,
+        tools: int,
+        warnings: list = None
+    ) -> str:
+        """Message for a single posted file"""
+        warnings_block = ""
         if warnings:
-            message += "⚠️ *Warnings:*\n"
-            for warning in warnings:
-                message += f"  • {warning}\n"
-            message += "\n"
-
-        message += "_File ready on FTP - grab it and run!_"
+            warnings_block = (
+                _WARNINGS_HEADER
+                + "".join(_WARNING_LINE_TPL.format(warning) for warning in warnings)
+                + "\n"
+            )
 
-        await self.send_message(message)
+        return _NEW_FILE_TPL.format(
+            part=part,
+            version=version,
+            project=project,
+            setup=setup,
+            machine=machine,
+            tools=tools,
+            warnings_block=warnings_block
+        )
 
     async def notify_cleanup(self, filename: str):
         """Notify that file was cleaned up from FTP"""
-        message = f"🗑️ Cleaned up: `{filename}`\n"
-        message += "_FTP directory cleaned_"
-        await self.send_message(message)
+        await self.send_message(_CLEANUP_TPL.format(filename=filename))
 
     async def notify_error(self, error_msg: str):
         """Notify about an error"""
-        message = f"❌ *Error in Chip Warden*\n\n"
-        message += f"```\n{error_msg}\n```"
-        await self.send_message(message)
+        await self.send_message(_ERROR_TPL.format(error_msg=error_msg))
 
     def send_message_sync(self, message: str):
         """
         Synchronous wrapper for sending messages
         Useful for non-async contexts
+
+        Called from inside a running event loop, blocking could deadlock, so
+        an awaitable is returned instead and the caller must await it. On the
+        notifier's own loop that is the send_message coroutine; on any other
+        loop it is a future for the send running on the notifier's loop.
+
+        Returns:
+            True if the message was sent; from async code, an awaitable
+            resolving to that result
         """
-        import asyncio
         try:
-            loop = asyncio.get_event_loop()
-            if loop.is_running():
-                # If loop is already running, schedule it
-                asyncio.create_task(self.send_message(message))
-            else:
-                # Run in new loop
-                asyncio.run(self.send_message(message))
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if running is self.loop:
+            return self.send_message(message)
+        if running is not None:
+            # The bot's HTTP client and rate limiter belong to self.loop
+            return asyncio.wrap_future(
+                asyncio.run_coroutine_threadsafe(self.send_message(message), self.loop)
+            )
+
+        try:
+            return self.run_coroutine(self.send_message(message), timeout=10)
         except Exception as e:
-            print(f"❌ Failed to send message: {e}")
+            logger.error(f"❌ Failed to send message: {e}")
+            return False
+
+
+def _scan_status(file_manager) -> Tuple[int, int]:
+    """
+    Count FTP programs and archived projects
+
+    Blocking directory walk - run it off the event loop.
+
+    Returns:
+        Tuple of (ftp_file_count, project_count)
+    """
+    with os.scandir(file_manager.ftp_dir) as entries:
+        ftp_count = sum(
+            1 for e in entries
+            if e.name.endswith('.nc') and e.is_file(follow_symlinks=False)
+        )
+    with os.scandir(file_manager.parts_archive) as entries:
+        project_count = sum(
+            1 for e in entries
+            if not e.name.startswith('.') and e.is_dir(follow_symlinks=False)
+        )
+    return ftp_count, project_count
 
 
 class TelegramCommandBot:
@@ -120,6 +389,11 @@ class TelegramCommandBot:
     /latest [part] - Show latest version of a part
     """
 
+    __slots__ = ("bot_token", "chat_id", "file_manager", "app", "_status_cache")
+
+    # Seconds a /status reply is reused for repeated requests
+    STATUS_CACHE_SECONDS = 2.0
+
     def __init__(self, bot_token: str, chat_id: str, file_manager=None):
         """
         Initialize command bot
@@ -137,49 +411,39 @@ class TelegramCommandBot:
         self.file_manager = file_manager
         self.app = None
 
+        # (monotonic time, message) of the last /status reply
+        self._status_cache = None
+
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command"""
-        await update.message.reply_text(
-            "🤖 *Russ here - Chip Warden is online*\n\n"
-            "Available commands:\n"
-            "/status - Show system status\n"
-            "/cleanup - Clean up old FTP files\n"
-            "/help - Show this message\n\n"
-            "_In Russ we trust._",
-            parse_mode='Markdown'
-        )
+        await update.message.reply_text(_START_MESSAGE, parse_mode='Markdown')
 
     async def status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /status command"""
-        # Check if message is from authorized chat
-        if str(update.effective_chat.id) != self.chat_id:
-            await update.message.reply_text("⛔ Unauthorized")
+        cached = self._status_cache
+        if cached and time.monotonic() - cached[0] < self.STATUS_CACHE_SECONDS:
+            await update.message.reply_text(cached[1], parse_mode='Markdown')
             return
 
         status = "✅ *Chip Warden Status*\n\n"
         status += "🤖 Russ is running\n"
 
         if self.file_manager:
-            # Count files in FTP
-            ftp_files = list(self.file_manager.ftp_dir.glob("*.nc"))
-            status += f"📤 FTP files: {len(ftp_files)}\n"
-
-            # Count archived projects
-            projects = [d for d in self.file_manager.parts_archive.iterdir() if d.is_dir() and not d.name.startswith('.')]
-            status += f"📦 Archived projects: {len(projects)}\n"
+            # Count FTP files and archived projects without blocking the loop
+            ftp_count, project_count = await asyncio.to_thread(_scan_status, self.file_manager)
+            status += f"📤 FTP files: {ftp_count}\n"
+            status += f"📦 Archived projects: {project_count}\n"
 
+        self._status_cache = (time.monotonic(), status)
         await update.message.reply_text(status, parse_mode='Markdown')
 
     async def cleanup_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /cleanup command"""
-        if str(update.effective_chat.id) != self.chat_id:
-            await update.message.reply_text("⛔ Unauthorized")
-            return
-
         await update.message.reply_text("🗑️ Cleaning up FTP directory...")
 
         if self.file_manager:
-            removed = self.file_manager.cleanup_old_ftp_files(keep_count=1)
+            # Blocking filesystem work - keep it off the event loop
+            removed = await asyncio.to_thread(self.file_manager.cleanup_old_ftp_files, keep_count=1)
             await update.message.reply_text(
                 f"✅ Removed {removed} old files from FTP",
                 parse_mode='Markdown'
@@ -193,16 +457,49 @@ class TelegramCommandBot:
 
     def start_bot(self):
         """Start the Telegram bot (blocking)"""
-        self.app = Application.builder().token(self.bot_token).build()
-
-        # Add command handlers
-        self.app.add_handler(CommandHandler("start", self.start_command))
-        self.app.add_handler(CommandHandler("status", self.status_command))
-        self.app.add_handler(CommandHandler("cleanup", self.cleanup_command))
-        self.app.add_handler(CommandHandler("help", self.help_command))
+        # getUpdates long-polls, so it gets its own pool and can't starve replies.
+        # No JobQueue (nothing is scheduled); replies go through PTB's rate limiter.
+        self.app = (
+            Application.builder()
+            .token(self.bot_token)
+            .request(_build_request())
+            .get_updates_request(_build_request(pool_size=1))
+            .concurrent_updates(True)
+            .job_queue(None)
+            .rate_limiter(AIORateLimiter(overall_max_rate=30, overall_time_period=1, max_retries=3))
+            .build()
+        )
 
-        print("🤖 Telegram bot started. Send /start to begin.")
-        self.app.run_polling()
+        # Updates from other chats are dropped by the dispatcher for the
+        # privileged commands - no handler call and no reply
+        authorized = filters.Chat(chat_id=int(self.chat_id))
+
+        # Add command handlers (non-blocking, so a slow /status doesn't hold up others)
+        commands = [
+            ("start", self.start_command, None),
+            ("status", self.status_command, authorized),
+            ("cleanup", self.cleanup_command, authorized),
+            ("help", self.help_command, None),
+        ]
+        self.app.add_handlers([
+            CommandHandler(name, callback, filters=chat_filter, block=False)
+            for name, callback, chat_filter in commands
+        ])
+
+        logger.info("🤖 Telegram bot started. Send /start to begin.")
+
+        # Webhook mode when a public HTTPS host is configured; otherwise long-poll
+        webhook_host = os.getenv('WEBHOOK_HOST')
+        if webhook_host:
+            self.app.run_webhook(
+                listen='0.0.0.0',
+                port=int(os.getenv('WEBHOOK_PORT', '8443')),
+                url_path=self.bot_token,
+                webhook_url=f"https://{webhook_host}/{self.bot_token}",
+                secret_token=os.getenv('WEBHOOK_SECRET')
+            )
+        else:
+            self.app.run_polling()
 
 
 def load_telegram_token(config_dir: str = "russ/config") -> Optional[str]:
@@ -222,11 +519,16 @@ def load_telegram_token(config_dir: str = "russ/config") -> Optional[str]:
         return token
 
     # Check file
-    token_file = Path(config_dir) / "telegram.token"
-    if token_file.exists():
-        return token_file.read_text().strip()
+    return _read_token_file(str(config_dir))
+
 
-    return None
+@functools.lru_cache(maxsize=8)
+def _read_token_file(config_dir: str) -> Optional[str]:
+    """Read config_dir/telegram.token once per directory"""
+    try:
+        return (Path(config_dir) / "telegram.token").read_text().strip()
+    except FileNotFoundError:
+        return None
 
 
 if __name__ == "__main__":
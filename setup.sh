@@ -67,6 +67,9 @@ python3 -c "from russ.gcode_parser import GCodeParser; from russ.file_manager im
     exit 1
 }
 
+# Pre-build bytecode so the first run (and test runs) skip compiling
+python3 -m compileall -q russ test_with_real_file.py
+
 echo ""
 echo "✅ Setup complete!"
 echo ""
@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 """
 Test Chip Warden with real 1001.nc file
+
+Usage:
+    python3 test_with_real_file.py [file.nc ...]
+
+With no arguments gcode/1001.nc is used. Several files are run through the
+same parser and file manager, the way Russ handles a burst of posts.
 """
 
 import sys
 import os
 import tempfile
+import subprocess
+from itertools import islice
 from pathlib import Path
+from typing import Optional
 
 # Add russ directory to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'russ'))
@@ -14,29 +23,21 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'russ'))
 from gcode_parser import GCodeParser
 from file_manager import FileManager
 
-def main():
-    # Create temp directories for testing
-    tmpdir = '/tmp/chip-warden-test'
-    os.makedirs(tmpdir, exist_ok=True)
-
-    archive_dir = f'{tmpdir}/archive'
-    ftp_dir = f'{tmpdir}/ftp'
-
-    print('🧪 Testing Chip Warden with your 1001.nc file...')
-    print('='*60)
-    print()
 
-    # Initialize components
-    parser = GCodeParser()
-    fm = FileManager(archive_dir, ftp_dir)
+def run_once(file_path: str, parser: GCodeParser, fm: FileManager) -> Optional[Path]:
+    """
+    Parse, archive and FTP-copy one file
 
+    Returns:
+        Path to the archived file, or None if the file had no metadata
+    """
     # Parse your file
-    print('🔍 Parsing gcode/1001.nc...')
-    metadata = parser.parse_file('gcode/1001.nc')
+    print(f'🔍 Parsing {file_path}...')
+    metadata = parser.parse_file(file_path)
 
     if not metadata:
         print('❌ Failed to parse metadata!')
-        return
+        return None
 
     print(f'✅ Parsed metadata:')
     print(f'   Project: {metadata.project}')
@@ -49,7 +50,7 @@ def main():
 
     # Archive it
     print('📦 Archiving to git repository...')
-    archived_path, version = fm.archive_gcode('gcode/1001.nc', metadata)
+    archived_path, version = fm.archive_gcode(file_path, metadata)
     print(f'✅ Archived as version {version}')
     print(f'   Path: {archived_path}')
     print()
@@ -60,48 +61,86 @@ def main():
     print(f'✅ FTP file: {ftp_path.name}')
     print()
 
+    return archived_path
+
+
+def run_test(tmpdir: str, files: list):
+    """Run files through a fresh archive/FTP layout under tmpdir and show the results"""
+    archive_dir = f'{tmpdir}/archive'
+    ftp_dir = f'{tmpdir}/ftp'
+
+    print(f'🧪 Testing Chip Warden with {", ".join(files)}...')
+    print('='*60)
+    print()
+
+    # Initialize components once for every file
+    parser = GCodeParser()
+    fm = FileManager(archive_dir, ftp_dir)
+
+    archived = [run_once(file_path, parser, fm) for file_path in files]
+    archived = [path for path in archived if path]
+    if not archived:
+        return
+
+    # Wait for the background git commit
+    fm.flush()
+
     # Show archive structure
     print('📁 Archive structure:')
     print('-'*60)
-    os.system(f'tree {archive_dir} 2>/dev/null || find {archive_dir} -type f | sort')
+    for path in sorted(Path(archive_dir).rglob('*')):
+        if path.is_file() and '.git' not in path.relative_to(archive_dir).parts:
+            print(path)
     print()
 
     # Show FTP directory
     print('📤 FTP directory contents:')
     print('-'*60)
-    os.system(f'ls -lh {ftp_dir}')
+    for path in sorted(Path(ftp_dir).iterdir()):
+        print(f'{path.stat().st_size:>10,}  {path.name}')
     print()
 
     # Check CHANGELOG
-    changelog = archived_path.parent / "CHANGELOG.md"
+    changelog = archived[-1].parent / "CHANGELOG.md"
     if changelog.exists():
         print('📝 CHANGELOG.md preview:')
         print('-'*60)
-        os.system(f'head -20 {changelog}')
+        with open(changelog) as f:
+            print(''.join(islice(f, 20)), end='')
         print()
 
     # Check git log
     print('📜 Git commit history:')
     print('-'*60)
-    os.system(f'cd {archive_dir} && git log --oneline -3 2>/dev/null')
+    log = subprocess.run(['git', '-C', archive_dir, 'log', '--oneline', '-3'], capture_output=True, text=True)
+    print(log.stdout, end='')
     print()
 
     # Show detailed commit
     print('📋 Latest commit details:')
     print('-'*60)
-    os.system(f'cd {archive_dir} && git log -1 2>/dev/null')
+    log = subprocess.run(['git', '-C', archive_dir, 'log', '-1'], capture_output=True, text=True)
+    print(log.stdout, end='')
     print()
 
+    fm.close()
+
     print('='*60)
     print('✅ Test complete!')
     print()
-    print(f'Test files located at: {tmpdir}')
-    print(f'   Archive: {archive_dir}')
-    print(f'   FTP: {ftp_dir}')
-    print()
     print('This is what Russ will do every time you post a file!')
     print()
 
 
+def main():
+    files = sys.argv[1:] or ['gcode/1001.nc']
+
+    # Fresh, self-cleaning directories for each run; tmpfs keeps git/file
+    # writes in RAM where available
+    shm = '/dev/shm' if Path('/dev/shm').is_dir() else None
+    with tempfile.TemporaryDirectory(prefix='chip-warden-test-', dir=shm) as tmpdir:
+        run_test(tmpdir, files)
+
+
 if __name__ == "__main__":
     main()